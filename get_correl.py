@@ -63,14 +63,15 @@ if __name__ == "__main__":
     species     = ['CO'] # edit to include species in model
     sp          = '_'.join(i for i in species)
     solar       = '1x'
+    res         = 'R100k' # model resolution, 1e6/opacity-sampling used in pRT_make_spec.py
     model_dir   = 'pRT_models/'
-    model_dir  += 'aumicb_{}Solar_{}_R1M/'.format(solar,sp)
+    model_dir  += 'aumicb_{}Solar_{}_{}/'.format(solar,sp,res)
     order_by_order = False # turn off these models for the moment (may be more efficient in future)
     if order_by_order:
         model_dir += 'order_by_order/'
 
     # results file
-    save_dir      = 'xcorr_result/'+'{}Solar_{}_R1M/'.format(solar,sp)
+    save_dir      = 'xcorr_result/'+'{}Solar_{}_{}/'.format(solar,sp,res)
     simple        = True # turn on (true)/off simple pearsonr cross-correlation
     if simple:
         save_dir += 'pearsonr/'
@@ -124,6 +125,16 @@ if __name__ == "__main__":
 
 
     print(nord,"orders detected")
+    # templates.npz (all orders, shared wavelength grid) if present, otherwise one pickle per order
+    templates = model_dir + 'templates.npz'
+    if os.path.exists(templates):
+        # read each member once (every NpzFile lookup decompresses it again)
+        with np.load(templates) as f:
+            W_all,DF_all = np.array(f['wlens'],dtype=float),np.array(f['DF'],dtype=float)
+            mod_orders,i0s,i1s = f['orders'],f['order_starts'],f['order_stops']
+    else:
+        templates = None
+
     list_ord = []
     for nn in range(nord):
         O        = Order(orders[nn])
@@ -135,8 +146,13 @@ if __name__ == "__main__":
 
         if order_by_order:
             # load model for each order
-            mod_file = model_dir + 'template_det' +str(orders[nn]) + '.pic'
-            W_mod,T_depth = pickle.load(open(mod_file,'rb'))
+            if templates is not None:
+                io      = np.where(mod_orders==orders[nn])[0][0]
+                W_mod   = W_all[i0s[io]:i1s[io]]
+                T_depth = DF_all[i0s[io]:i1s[io]]
+            else:
+                mod_file = model_dir + 'template_det' +str(orders[nn]) + '.pic'
+                W_mod,T_depth = pickle.load(open(mod_file,'rb'))
             O.Wm     = W_mod
             O.Im     = T_depth
         list_ord.append(O)
@@ -150,8 +166,11 @@ if __name__ == "__main__":
     #maxf           = ndimage.maximum_filter(T_depth,size=10000)
 
     if not order_by_order:
-        mod_file = model_dir + 'template_det1.pic'
-        W_mod,T_depth = pickle.load(open(mod_file,'rb'))
+        if templates is not None:
+            W_mod,T_depth = W_all,DF_all
+        else:
+            mod_file = model_dir + 'template_det1.pic'
+            W_mod,T_depth = pickle.load(open(mod_file,'rb'))
         for kk,O in enumerate(list_ord):
             Wmin,Wmax = 0.95*O.W_fin.min(),1.05*O.W_fin.max()
             indm      = np.where((W_mod>Wmin)&(W_mod<Wmax))[0]
@@ -13,24 +13,28 @@ run with python3610 (or python368) on TITAN
 ### Goals:
 #   Generate a 1D planet atmosphere template for each order using the petitRADTRANS python module
 #   https://petitradtrans.readthedocs.io/en/latest/
-#   Produces model of R~10^6
+#   Produces model of R~10^6 (divided by the opacity sampling, R~10^5 by default)
 
 ### Inputs:
 #   - Rp: planet radius (Rjup)
 #   - Rs: stellar radius (Rsun)
 #   - grav: surface gravity (cgs)
 #   - Teq: planet equilibrium temp (K)
-#   - Teff: stellar effective temp (K)
-#   - Tint: planet interior temp (K)
+#   - Teff: stellar effective temp (K) -- not used by the isothermal model
+#   - Tint: planet interior temp (K), if given the model temperature is (Tint^4+Teq^4)^(1/4) instead of Teq
 #   - mmw: mean molecular weight (cgs)
 #   - wmin: min wlen (um)
 #   - wmax: max wlen (um)
 #   - wlens-file: path to wlen file, overrules wmin/max (um)
 #   - species: a list of high-res line lists to include in model
+#   - legacy-pickle: save one pickle per order instead of a single templates.npz
+#   - opacity-sampling: use every N-th point of the line-by-line opacities (default 10)
+#   - target-R: resolution needed downstream, sets the opacity sampling to 1e6/target-R
 
 
 ### Modules
 #   - Standard python modules: numpy and time
+#   - numba (optional): speeds up the DF = -Rp^2/Rs^2 step, numpy is used if not installed
 #   - petitRADTRANS: installed on titan (on a local folder)
 #     To run the code and load the module on the titan computer cluster:
 #     1 - add "export PYTHONPATH=/data/atmo/petitRADTRANS-master/:$PYTHONPATH" to ~/.bashrc
@@ -45,26 +49,188 @@ run with python3610 (or python368) on TITAN
 # ----------------------------------------------------------------------------------------------------------- #
 
 import argparse
+import copy
+import difflib
+import hashlib
+import multiprocessing
 import numpy as np
 import os
+import sys
+import tempfile
 import time
+import petitRADTRANS
 from petitRADTRANS import Radtrans
 from petitRADTRANS import nat_cst as nc
 import pickle
-
-def compute_model(wmin,wmax,wfactor):
-    lamb_inf,lamb_sup = (1-wfactor)*wmin,wmax*(1+wfactor)
-
-    ### make model
+from concurrent.futures import ProcessPoolExecutor
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+_DEFAULT_PRESSURES = np.geomspace(1e-10, 1e2, 100)  # Pressure grid [bar]
+
+MAX_OPACITY_SAMPLING = 100 # keeps the model grid at R>=10^4
+
+def opacity_sampling(target_R,default=10):
+    # pRT line-by-line opacities are at R~10^6, sample every N-th point to reach target_R
+    # e.g. R=20000 -> N=50, ~5x fewer points than the default N=10
+    if target_R is None:
+        return default
+    return min(max(int(1e6/target_R),1),MAX_OPACITY_SAMPLING)
+
+def isothermal_temperature(Teq,Tint=None):
+    """
+    Temperature of the isothermal model [K]: Teq, or (Tint^4+Teq^4)^(1/4) to add the internal heat
+
+    >>> isothermal_temperature(600)
+    600
+    >>> round(isothermal_temperature(600,100),3)
+    600.116
+    >>> isothermal_temperature(0,300)
+    300.0
+    """
+    if Tint is None:
+        return Teq
+    return (Tint**4+Teq**4)**0.25
+
+def resolution_label(sampling):
+    # effective resolution of the model, used in the output directory name (R1M, R100k, R20k...)
+    R = 1e6/sampling
+    return 'R1M' if R>=1e6 else 'R{:d}k'.format(int(round(R/1e3)))
+
+def make_atmosphere(wmin,wmax,wfactor,sampling=10):
+    lamb_inf,lamb_sup = (1-wfactor)*np.min(wmin),np.max(wmax)*(1+wfactor)
+
+    ### make model -- done once, reading the opacities is the expensive part
     atmosphere = Radtrans(line_species = LS, \
                       rayleigh_species = ['H2', 'He'], \
                       continuum_opacities = ['H2-H2', 'H2-He'], \
                       wlen_bords_micron = [lamb_inf,lamb_sup], \
                       mode = 'lbl', \
-                      lbl_opacity_sampling=10)
+                      lbl_opacity_sampling=sampling)
 
     atmosphere.setup_opa_structure(pressures)
 
+    return atmosphere
+
+# species name -> pRT line list
+SPECIES_MAP = {'CO':'CO_all_iso','H2O':'H2O_main_iso','CO2':'CO2_main_iso','CH4':'CH4_main_iso',\
+               'HCN':'HCN_main_iso','NH3':'NH3_main_iso','H2':'H2_main_iso'}
+
+def line_species(species):
+    # pRT line lists for the requested species, in the order they were given (duplicates removed)
+    LS = []
+    for s in dict.fromkeys(species):
+        if s not in SPECIES_MAP:
+            close = difflib.get_close_matches(s,SPECIES_MAP.keys(),n=1)
+            hint  = ", did you mean '{}'?".format(close[0]) if close else ''
+            raise KeyError("unknown species '{}'{} (available: {})".format(s,hint,', '.join(SPECIES_MAP)))
+        LS.append(SPECIES_MAP[s])
+    return LS
+
+# pRT dicts holding one entry per line species
+SPECIES_OPACITIES = ['line_grid_kappas_custom_PT','custom_line_TP_grid','custom_line_paths', \
+                     'custom_diffTs','custom_diffPs','custom_grid']
+
+def drop_weak_species(atmosphere,min_contribution):
+    # peak mass-weighted line opacity of each species, at the model temperature and pressures,
+    # relative to the strongest one; species below min_contribution are removed from the loaded
+    # opacities and the per-layer buffers are set up again for the remaining species
+    atmosphere.interpolate_species_opas(temperature,abundances)
+    kappas = atmosphere.line_struc_kappas # (g, freq, species, layers)
+    peak   = np.array([abundances[s][0]*kappas[:,:,i,:].max() for i,s in enumerate(atmosphere.line_species)])
+    keep   = np.where(peak>=min_contribution*peak.max())[0]
+    if len(keep)==len(peak):
+        return list(atmosphere.line_species)
+    for i in range(len(peak)):
+        if i not in keep:
+            print("WARNING: dropping {} (relative contribution {:.1e} < {:.1e})".format(\
+                  atmosphere.line_species[i],peak[i]/peak.max(),min_contribution))
+    # the line opacities and their P-T grids are dicts keyed by species
+    dropped = [s for i,s in enumerate(atmosphere.line_species) if i not in keep]
+    for attr in SPECIES_OPACITIES:
+        grid = getattr(atmosphere,attr,None)
+        if isinstance(grid,dict):
+            for s in dropped:
+                grid.pop(s,None)
+    atmosphere.line_species = [atmosphere.line_species[i] for i in keep]
+    atmosphere.setup_opa_structure(pressures)
+    return list(atmosphere.line_species)
+
+# read-only opacity tables filled when pRT reads the opacity files (pRT's per-call buffers are not shared)
+# line_grid_kappas_custom_PT is a dict of one array per species (each species has its own P-T grid)
+SHARED_OPACITIES = ['line_grid_kappas_custom_PT', \
+                    'cia_h2h2_alpha_grid','cia_h2h2_lambda','cia_h2h2_temp', \
+                    'cia_h2he_alpha_grid','cia_h2he_lambda','cia_h2he_temp']
+
+def _shm_view(shm,shape,dtype,fortran):
+    return np.ndarray(shape,dtype=dtype,buffer=shm.buf,order='F' if fortran else 'C')
+
+def share_opacities(atmosphere):
+    # move the opacity tables into shared memory, one block per array (per species for dicts),
+    # so that worker processes attach to a single copy instead of re-reading the opacity files (python>=3.8)
+    # returns the (picklable) handles to pass to attach_opacities and the blocks to unlink at the end
+    from multiprocessing import shared_memory
+    handles,blocks = {},[]
+    for attr in SHARED_OPACITIES:
+        value = getattr(atmosphere,attr,None)
+        if isinstance(value,dict):
+            arrays = [(species,arr) for species,arr in value.items() if isinstance(arr,np.ndarray)]
+        elif isinstance(value,np.ndarray):
+            arrays = [(None,value)]
+        else:
+            continue
+        for species,arr in arrays:
+            shm  = shared_memory.SharedMemory(create=True,size=max(arr.nbytes,1))
+            view = _shm_view(shm,arr.shape,arr.dtype,np.isfortran(arr))
+            view[...] = arr
+            if species is None:
+                setattr(atmosphere,attr,view)
+            else:
+                value[species] = view
+            handles[(attr,species)] = (shm.name,arr.shape,arr.dtype.str,np.isfortran(arr))
+            blocks.append(shm)
+    if not any(attr=='line_grid_kappas_custom_PT' for attr,_ in handles):
+        print("WARNING: no line opacities found to share, each worker uses its own copy")
+    return handles,blocks
+
+def attach_opacities(atmosphere,handles):
+    # view the shared opacity blocks from a worker process (no copy)
+    from multiprocessing import shared_memory
+    blocks = []
+    for (attr,species),(name,shape,dtype,fortran) in handles.items():
+        shm  = shared_memory.SharedMemory(name=name)
+        view = _shm_view(shm,shape,dtype,fortran)
+        if species is None:
+            setattr(atmosphere,attr,view)
+        else:
+            getattr(atmosphere,attr)[species] = view
+        blocks.append(shm)
+    return blocks
+
+def model_cache_file(cache_dir,wmin,wmax,wfactor,sampling,min_contribution):
+    # models are stored under a hash of everything that goes into them (including the pRT version)
+    params = (tuple(sorted(LS)),Rp,gravity,P0,float(temperature[0]),float(MMW[0]), \
+              tuple(sorted((k,float(v[0])) for k,v in abundances.items())), \
+              float(np.min(wmin)),float(np.max(wmax)),wfactor,sampling,min_contribution, \
+              getattr(petitRADTRANS,'__version__','unknown'))
+    key = hashlib.blake2b(repr(params).encode(),digest_size=8).hexdigest()
+    return os.path.join(cache_dir,key+'.npz')
+
+def save_model_cache(model_file,Rtransit,wlens):
+    # write to a temporary file next to the cache entry and move it in place,
+    # so that an interrupted run never leaves a truncated <key>.npz behind
+    fd,tmp = tempfile.mkstemp(dir=os.path.dirname(model_file),suffix='.tmp')
+    try:
+        with os.fdopen(fd,'wb') as f:
+            np.savez(f,Rtransit=Rtransit,wlens=wlens)
+        os.replace(tmp,model_file)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+def compute_model(atmosphere):
     atmosphere.calc_transm(temperature,abundances,gravity,MMW,\
                                R_pl=Rp,P0_bar=P0)
 
@@ -73,8 +239,75 @@ def compute_model(wmin,wmax,wfactor):
     wlens   = nc.c/atmosphere.freq #cm
     wlens /= 1e-4
 
+    # increasing wavelengths, needed to slice the orders with searchsorted
+    if wlens[0]>wlens[-1]:
+        Rtransit,wlens = Rtransit[::-1],wlens[::-1]
+
     return Rtransit, wlens
 
+if njit is not None:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _compute_DF(Rtransit,inv_Rs2_neg,out):
+        # DF = -Rtransit^2/Rs^2 in a single pass, no temporary arrays and no division
+        for i in prange(len(Rtransit)):
+            out[i] = Rtransit[i]*Rtransit[i]*inv_Rs2_neg
+        return out
+else:
+    def _compute_DF(Rtransit,inv_Rs2_neg,out):
+        np.multiply(Rtransit,Rtransit,out=out)
+        np.multiply(out,inv_Rs2_neg,out=out)
+        return out
+
+def _slice_freq(attr,arr,i0,i1,nfreq):
+    # slice the frequency axis of one pRT array (border_freqs has nfreq+1 points)
+    extra = 1 if attr=='border_freqs' else 0
+    axes  = [k for k,n in enumerate(arr.shape) if n==nfreq+extra]
+    if len(axes)==0:
+        return arr
+    if len(axes)>1:
+        raise ValueError("cannot tell the frequency axis of {} (shape {})".format(attr,arr.shape))
+    sl = [slice(None)]*arr.ndim
+    sl[axes[0]] = slice(i0,i1+extra)
+    return arr[tuple(sl)]
+
+def order_atmosphere(atmosphere,wmin,wmax,wfactor):
+    # shallow copy of the atmosphere restricted to one order: every array with a frequency axis,
+    # including the per-species arrays held in dicts, is sliced along it (a view, no copy),
+    # so that calc_transm only runs over the order
+    lamb_inf,lamb_sup = (1-wfactor)*wmin,wmax*(1+wfactor)
+    wlens = nc.c/atmosphere.freq/1e-4
+    ind   = np.where((wlens>=lamb_inf)&(wlens<=lamb_sup))[0]
+    if len(ind)==0:
+        raise ValueError("no model wavelengths in [{:.4f},{:.4f}] um, check the wlens file".format(lamb_inf,lamb_sup))
+    i0,i1 = ind[0],ind[-1]+1
+    nfreq = len(atmosphere.freq)
+    sub   = copy.copy(atmosphere)
+    for attr,value in vars(atmosphere).items():
+        if isinstance(value,np.ndarray):
+            setattr(sub,attr,_slice_freq(attr,value,i0,i1,nfreq))
+        elif isinstance(value,dict) and any(isinstance(v,np.ndarray) for v in value.values()):
+            setattr(sub,attr,{k:_slice_freq(attr,v,i0,i1,nfreq) if isinstance(v,np.ndarray) else v \
+                              for k,v in value.items()})
+    if hasattr(sub,'freq_len'):
+        sub.freq_len = i1-i0
+    return sub
+
+def _attach_shm(handles):
+    # worker initializer: view the shared opacities instead of a private copy
+    global _shm_blocks
+    _shm_blocks = attach_opacities(atmosphere,handles)
+
+def _worker(idet,wmin,wmax,wfactor):
+    Rtransit,wlens = compute_model(order_atmosphere(atmosphere,wmin,wmax,wfactor))
+    return idet,Rtransit,wlens
+
+def order_slices(wlens,wmin,wmax,wfactor):
+    # start/stop indices of each order's (extended) window in the sorted wavelength grid
+    lamb_inf,lamb_sup = (1-wfactor)*np.atleast_1d(wmin),np.atleast_1d(wmax)*(1+wfactor)
+    starts = np.searchsorted(wlens,lamb_inf,side='left')
+    stops  = np.searchsorted(wlens,lamb_sup,side='right')
+    return starts, stops
+
 
 if __name__=="__main__":
     parser = argparse.ArgumentParser()
@@ -83,8 +316,8 @@ if __name__=="__main__":
     parser.add_argument("--Rs", type=float, required=True, help='stellar radius (Rsun)')
     parser.add_argument("--grav", type=float, required=True, help='surface gravity (cgs)')
     parser.add_argument("--Teq", type=int, required=True, help='planet equilibrium temp (K)')
-    parser.add_argument("--Teff", type=int, default=None, help='stellar effective temp (K)')
-    parser.add_argument("--Tint", type=int, default=None, help='planet interior temp (K)')
+    parser.add_argument("--Teff", type=int, default=None, help='stellar effective temp (K), not used by the isothermal model')
+    parser.add_argument("--Tint", type=int, default=None, help='planet interior temp (K), if given T=(Tint^4+Teq^4)^(1/4) instead of Teq')
     parser.add_argument("--mmw", type=float, required=True, help='mean molecular weight (cgs)')
     parser.add_argument("--wmin", type=float, default=1.2, help='min wlen (um), use for a single model')
     parser.add_argument("--wmax", type=float, default=2.5, help='max wlen (um), use for a single model')
@@ -92,10 +325,34 @@ if __name__=="__main__":
         help='path to wlen file, overrules wmin/max (um), can use for order_by_order models')
     parser.add_argument("--species", type=str, default=['H2'], nargs='+', \
         help='lbl species, see https://petitradtrans.readthedocs.io/en/latest/content/available_opacities.html for full list')
+    parser.add_argument("--opacity-sampling", type=int, default=10, \
+        help='sample every N-th point of the R~10^6 line-by-line opacities')
+    parser.add_argument("--target-R", type=float, default=None, \
+        help='resolution needed downstream, overrules opacity-sampling (e.g. 20000 -> sampling of 50, at most 100)')
+    parser.add_argument("--min-abundance", type=float, default=1e-8, \
+        help='leave out line species with a mass fraction below this value')
+    parser.add_argument("--min-contribution", type=float, default=0.0, \
+        help='leave out line species whose peak opacity (x mass fraction) is below this fraction of the strongest species')
+    parser.add_argument("--model-cache", type=str, default=os.path.expanduser('~/.cache/pRT_templates'), \
+        help='directory where computed models are kept and reused for identical parameters')
+    parser.add_argument("--no-model-cache", action="store_true", default=False, \
+        help='always recompute the model, do not read or write the model cache')
+    parser.add_argument("--workers", type=int, default=1, \
+        help='number of worker processes computing the orders in parallel (python>=3.8), the opacities are shared between them')
+    parser.add_argument("--check-parallel", action="store_true", default=False, \
+        help='with --workers, also compute the wide-band model and check the first order against it')
+    parser.add_argument("--legacy-pickle", action="store_true", default=False, \
+        help='save one template_det<order>.pic per order instead of a single templates.npz')
 
 
 
     args = parser.parse_args()
+    if args.target_R is not None and args.target_R<=0:
+        parser.error("--target-R must be > 0")
+    if args.opacity_sampling<1:
+        parser.error("--opacity-sampling must be >= 1")
+    if args.workers>1 and sys.version_info<(3,8):
+        parser.error("--workers > 1 needs python>=3.8 (multiprocessing.shared_memory)")
 
     # Create directory for models
     #save_dir = '{:s}_pRTmodels/'.format(args.planet)
@@ -118,24 +375,16 @@ if __name__=="__main__":
     Teff      = args.Teff
     Tint      = args.Tint
 
-    pressures = np.logspace(-10, 2, 100)  # Pressure grid [bar]
-    if Teff is not None:
-        temperature = Teff*(Tint^4+Teq^4)**0.25 * np.ones_like(pressures)
-    else:
-        temperature  = Teq * np.ones_like(pressures)
-    MMW       = mmw * np.ones_like(temperature)
+    pressures = _DEFAULT_PRESSURES.copy() # Pressure grid [bar]
+    T0        = isothermal_temperature(Teq,Tint)
+    print("\nIsothermal temperature: {:.1f} K".format(T0))
+    temperature = np.full_like(pressures,T0)  # isothermal
+    MMW         = np.full_like(pressures,mmw)
 
     ### lbl species  --  for petitRADTRANS
     #LS = ['H2O_main_iso','CO_all_iso','NH3_main_iso','CO2_main_iso','CH4_main_iso','HCN_main_iso']
     species   = args.species
-    LS        = []
-    if 'CO' in species: LS.append('CO_all_iso')
-    if 'H2O' in species: LS.append('H2O_main_iso')
-    if 'CO2' in species: LS.append('CO2_main_iso')
-    if 'CH4' in species: LS.append('CH4_main_iso')
-    if 'HCN' in species: LS.append('HCN_main_iso')
-    if 'NH3' in species: LS.append('NH3_main_iso')
-    if 'H2' in species: LS.append('H2_main_iso')
+    LS        = line_species(species)
     print("\nIncluding species: {}".format(LS))
 
     t0 = time.time()
@@ -143,15 +392,30 @@ if __name__=="__main__":
 
     ### Abundances in MASSIVE FRACTIONS - set to solar
     solar = '1x'
-    abundances                   =  {}
-    abundances['H2']             =  0.71 * np.ones_like(pressures)
-    abundances['He']             =  0.27 * np.ones_like(pressures)
-    abundances['H2O_main_iso']            =  1e-3 * np.ones_like(pressures)
-    abundances['CO_all_iso']     =  1e-3 * np.ones_like(pressures)
-    abundances['NH3']            =  2.2e-5* np.ones_like(pressures)
-    abundances['CO2_main_iso']            =  1e-4 * np.ones_like(pressures)
-    abundances['CH4_main_iso']            =  1e-3 * np.ones_like(pressures)
-    abundances['HCN_main_iso']            =  1.1e-4* np.ones_like(pressures)
+    mass_fractions = {'H2'           : 0.71,
+                      'He'           : 0.27,
+                      'H2_main_iso'  : 0.71,
+                      'H2O_main_iso' : 1e-3,
+                      'CO_all_iso'   : 1e-3,
+                      'NH3_main_iso' : 2.2e-5,
+                      'CO2_main_iso' : 1e-4,
+                      'CH4_main_iso' : 1e-3,
+                      'HCN_main_iso' : 1.1e-4}
+
+    # no need to load (and integrate) the line lists of species that are not there
+    dropped     = [s for s in LS if mass_fractions.get(s,0.0)<=args.min_abundance]
+    if len(dropped)>0:
+        print("WARNING: mass fraction <= {:.1e}, leaving out {}".format(args.min_abundance,dropped))
+        LS      = [s for s in LS if s not in dropped]
+
+    # one (nspecies,nlayers) block, each pRT abundance is a view on a row of it
+    # change a value for all layers with abund_block[i,:] = new_value
+    abund_keys  = ['H2','He'] + LS
+    abund_block = np.empty((len(abund_keys),len(pressures)),dtype=np.float64)
+    abundances  = {}
+    for i,key in enumerate(abund_keys):
+        abund_block[i,:] = mass_fractions.get(key,0.0)
+        abundances[key]  = abund_block[i,:]
 
     #abundances['CO_all_iso']     = 0.012* np.ones_like(pressures)
     #abundances['NH3_main_iso']   = 2.2 * 10**(-5) * np.ones_like(pressures)
@@ -174,15 +438,12 @@ if __name__=="__main__":
         #Wm         = A[:,3]
         A          = pickle.load(open(rep_wave,'rb'))
         ndet       = len(A)
-        W_min      = []
-        W_max      = []
-        for idet in range(ndet):
-            W_min.append(A[idet][0])
-            W_max.append(A[idet][-1])
-        W_min      = np.array(W_min)
-        W_max      = np.array(W_max)
-        W_min /= 1e3 #convert to um
-        W_max /= 1e3
+        if isinstance(A,np.ndarray) and A.ndim==2:
+            W_min  = A[:,0]*1e-3 #convert to um
+            W_max  = A[:,-1]*1e-3
+        else:
+            W_min  = np.fromiter((a[0] for a in A),dtype=np.float64,count=ndet)*1e-3
+            W_max  = np.fromiter((a[-1] for a in A),dtype=np.float64,count=ndet)*1e-3
         Wm         = (W_min+W_max)/2 # not needed?
         det        = np.arange(ndet) # at some point edit this to correspond to actual order numbers
 
@@ -197,7 +458,8 @@ if __name__=="__main__":
 
     # specfic directory for these models
     sp = '_'.join(i for i in species)
-    save_dir += '{:s}_{}Solar_{}_R1M/'.format(args.planet,solar,sp)
+    sampling  = opacity_sampling(args.target_R,args.opacity_sampling)
+    save_dir += '{:s}_{}Solar_{}_{}/'.format(args.planet,solar,sp,resolution_label(sampling))
     if order_by_order:
         print('\ncomputing a single model for each order')
         save_dir += 'order_by_order/'
@@ -205,35 +467,103 @@ if __name__=="__main__":
     # ----------------------------------------------------------------------------------------------------------- #
     ####### MAIN LOOP - COMPUTE MODEL FOR EACH ORDER
     # ----------------------------------------------------------------------------------------------------------- #
-    for idet in range(ndet):
-        tx = "Order " + str(det[idet])
-        print(tx)
-        Rtransit,wlens = compute_model(W_min,W_max,wfactor)
-
-        DF   = -1.0* Rtransit**(2)/Rs**(2)
-        ### Store the results
-        #rep_fin = save_dir+ 'template_' + str(det[idet]) + '.bin'
-        rep_fin = save_dir+ 'template_det' +str(det[idet]) + '.pic'
-
-        #file = open(rep_fin,'w')
-        #tx   = '### Model atmosphere {} - Order {} \n'.format(args.planet,det[idet])
-        #tx  += '### Code: petitRADTRANS - 1D homogeneous isothermal atmosphere\n'
-        #tx  += '### Massive fractions: '
-
-        #for key in abundances:
-        #    tx += str(key) + ": " + str(abundances[key][0]) + " "
-        #tx += "\n"
-
-        #tx  += '### T_eq = ' + str(Teq) +  ' K - mu = ' + str(mmw) + '\n'
-        #tx  += '### Wavelength  -Rp^2/Rs^2\n'
-        #file.write(tx)
-        #for nn in range(len(DF)):
-        #    tx = str(wlens[nn]) + ' ' + str(DF[nn]) + '\n'
-        #    file.write(tx)
-        #file.close()
-
-        pickle.dump([wlens,DF],open(rep_fin,'wb'),protocol=2)
-        # lines 148-165 would be good to save as pickles instead (the full spectral matrices and wavelengths in one file) - much more efficient
+    # a single Radtrans object spanning all orders, unless the same model was computed before
+    print("\nOpacity sampling: {} ({})".format(sampling,resolution_label(sampling)))
+    atmosphere  = None
+    model_file  = None
+    shm_handles = None
+    starts      = None
+    if not args.no_model_cache:
+        if not os.path.exists(args.model_cache): os.makedirs(args.model_cache)
+        model_file = model_cache_file(args.model_cache,W_min,W_max,wfactor,sampling,args.min_contribution)
+
+    if model_file is not None and os.path.exists(model_file):
+        print("\nLoading model from {}".format(model_file))
+        with np.load(model_file) as model:
+            Rtransit_full,wlens_full = model['Rtransit'],model['wlens']
+    else:
+        atmosphere = make_atmosphere(W_min,W_max,wfactor,sampling)
+        if args.min_contribution>0:
+            LS = drop_weak_species(atmosphere,args.min_contribution)
+
+        if args.workers>1 and ndet>1:
+            # one model per order, computed in parallel on the shared opacities
+            # (the models overlap, they are stored one after the other with their own start/stop)
+            print("\nSharing opacities between {} workers".format(args.workers))
+            shm_handles,shm_blocks = share_opacities(atmosphere)
+            model_file = None
+            with ProcessPoolExecutor(max_workers=args.workers,mp_context=multiprocessing.get_context('fork'),\
+                                     initializer=_attach_shm,initargs=(shm_handles,)) as pool:
+                futures = [pool.submit(_worker,idet,W_min[idet],W_max[idet],wfactor) for idet in range(ndet)]
+                results = [f.result() for f in futures]
+            Rtransit_full = np.concatenate([r[1] for r in results])
+            wlens_full    = np.concatenate([r[2] for r in results])
+            stops         = np.cumsum([len(r[2]) for r in results])
+            starts        = stops - np.array([len(r[2]) for r in results])
+            if args.check_parallel:
+                # the first order must match the same window of the single wide-band model
+                R_ref,w_ref = compute_model(atmosphere)
+                i0,i1       = order_slices(w_ref,W_min[0],W_max[0],wfactor)
+                if not (np.array_equal(w_ref[i0[0]:i1[0]],results[0][2]) and \
+                        np.allclose(R_ref[i0[0]:i1[0]],results[0][1],rtol=1e-6)):
+                    raise RuntimeError("order {} from the workers differs from the wide-band model".format(det[0]))
+                print("Order {} matches the wide-band model".format(det[0]))
+        else:
+            # the model is computed once over all orders, each order is a slice of it
+            Rtransit_full,wlens_full = compute_model(atmosphere)
+            if model_file is not None:
+                save_model_cache(model_file,Rtransit_full,wlens_full)
+
+    if starts is None:
+        starts,stops = order_slices(wlens_full,W_min,W_max,wfactor)
+    inv_Rs2_neg = -1.0/(Rs*Rs)
+    DF_full     = np.empty(len(Rtransit_full))
+    _compute_DF(np.ascontiguousarray(Rtransit_full),inv_Rs2_neg,DF_full)
+
+    if not args.legacy_pickle:
+        # all orders in one compressed file, sharing a single wavelength grid:
+        # order idet is wlens[order_starts[idet]:order_stops[idet]]
+        rep_fin = save_dir + 'templates.npz'
+        print("Saving {} orders to {}".format(ndet,rep_fin))
+        np.savez_compressed(rep_fin, wlens=wlens_full.astype(np.float32), \
+                            DF=DF_full.astype(np.float32), orders=np.asarray(det), \
+                            order_starts=starts, order_stops=stops, sampling=sampling)
+    else:
+        for idet in range(ndet):
+            tx = "Order " + str(det[idet])
+            print(tx)
+            wlens    = wlens_full[starts[idet]:stops[idet]]
+            DF       = DF_full[starts[idet]:stops[idet]]
+
+            ### Store the results
+            #rep_fin = save_dir+ 'template_' + str(det[idet]) + '.bin'
+            rep_fin = save_dir+ 'template_det' +str(det[idet]) + '.pic'
+
+            #file = open(rep_fin,'w')
+            #tx   = '### Model atmosphere {} - Order {} \n'.format(args.planet,det[idet])
+            #tx  += '### Code: petitRADTRANS - 1D homogeneous isothermal atmosphere\n'
+            #tx  += '### Massive fractions: '
+
+            #for key in abundances:
+            #    tx += str(key) + ": " + str(abundances[key][0]) + " "
+            #tx += "\n"
+
+            #tx  += '### T_eq = ' + str(Teq) +  ' K - mu = ' + str(mmw) + '\n'
+            #tx  += '### Wavelength  -Rp^2/Rs^2\n'
+            #file.write(tx)
+            #for nn in range(len(DF)):
+            #    tx = str(wlens[nn]) + ' ' + str(DF[nn]) + '\n'
+            #    file.write(tx)
+            #file.close()
+
+            pickle.dump([wlens,DF],open(rep_fin,'wb'),protocol=pickle.HIGHEST_PROTOCOL)
+
+    if shm_handles is not None:
+        for attr,_ in shm_handles:
+            setattr(atmosphere,attr,None) # release the views before freeing the blocks
+        for shm in shm_blocks:
+            shm.close()
+            shm.unlink()
 
     t1  = time.time()
     tx  = "DONE\n"